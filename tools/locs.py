@@ -8,14 +8,38 @@
 """
 
 import argparse
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
 import json
+import mmap
 import os
 import re
+import shlex
+import shutil
 import subprocess
 import sys
-import tempfile
 import time
-from pathlib import Path
+
+try:
+  # Streams compile_commands.json instead of loading it at once.
+  import ijson
+except ImportError:
+  ijson = None
+
+try:
+  # Serializes the --json output much faster than the json module.
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  # RE2 matches without backtracking, which helps on very long commands.
+  import re2 as command_re
+except ImportError:
+  command_re = re
 
 ARGPARSE = argparse.ArgumentParser(
     description=("A script that computes LoC for a build dir or from a"
@@ -111,15 +135,140 @@ ARGPARSE.add_argument(
     default=0,
     const=3,
     help="Output results for each file separately")
+ARGPARSE.add_argument(
+    '--cache',
+    action='store_true',
+    default=False,
+    help=("Reuse results of unchanged input files from previous runs\n"
+          "(stored in .locs_cache.json next to compile_commands.json;\n"
+          "changes to included headers are not detected)"))
+ARGPARSE.add_argument(
+    '--tokei',
+    action='store_true',
+    default=False,
+    help=("Count LoC of input files with tokei if it is installed\n"
+          "(its comment handling differs from the built-in counting)"))
 
 ARGS = vars(ARGPARSE.parse_args())
 
 
 def MaxWidth(strings):
-  max_width = 0
-  for s in strings:
-    max_width = max(max_width, len(s))
-  return max_width
+  return max(map(len, strings), default=0)
+
+
+# Lines containing anything but whitespace. Like 'wc -l', only lines ending
+# in a newline are counted.
+NON_BLANK_LINE = re.compile(rb'(?m)^[^\S\n]*\S[^\n]*\n')
+# Non-blank lines that are neither '//' comments nor start with '/*' or '*'.
+CODE_LINE = re.compile(rb'(?m)^(?![^\S\n]*//|/\*|\*)[^\S\n]*\S[^\n]*\n')
+
+
+def CountLines(path, pattern):
+  """Counts the lines of the given file matched by pattern."""
+  with open(path, 'rb') as file:
+    if os.fstat(file.fileno()).st_size == 0:
+      return 0
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      return sum(1 for _ in pattern.finditer(data))
+
+
+@functools.lru_cache(maxsize=None)
+def ResolveExecutable(name):
+  """Resolves a bare executable name against PATH.
+
+  The few distinct compilers are looked up once each, so that spawning them
+  does not probe every PATH entry again for each unit.
+  """
+  if os.path.dirname(name):
+    return name
+  return shutil.which(name) or name
+
+
+def CompilerArgv(clangcmd):
+  """Splits a compiler command line into an argv list."""
+  argv = shlex.split(clangcmd)
+  argv[0] = ResolveExecutable(argv[0])
+  return argv
+
+
+STREAM_CHUNK_SIZE = 1 << 20
+
+
+def CountStreamLines(stream, pattern):
+  """Counts the lines read from stream that are matched by pattern.
+
+  The stream is consumed in chunks as it is produced, so its content is never
+  held in memory as a whole.
+  """
+  count = 0
+  tail = b''
+  for chunk in iter(functools.partial(stream.read, STREAM_CHUNK_SIZE), b''):
+    chunk = tail + chunk
+    # Only scan complete lines; the rest is prepended to the next chunk.
+    end = chunk.rfind(b'\n') + 1
+    count += sum(1 for _ in pattern.finditer(chunk, 0, end))
+    tail = chunk[end:]
+  return count + sum(1 for _ in pattern.finditer(tail))
+
+
+def ProcessCompilationUnit(argv, directory, infile, count_loc):
+  """Preprocesses a single compilation unit and counts its lines of code.
+
+  The preprocessor output is counted while it is being piped from the
+  preprocessor. Preprocessing is skipped if argv is None. Returns the tuple
+  (loc, expanded, returncode). loc is None unless count_loc is
+  set, and returncode is the preprocessor's exit status.
+  """
+  expanded = 0
+  returncode = 0
+  if argv:
+    try:
+      with subprocess.Popen(argv, cwd=directory, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE) as process:
+        expanded = CountStreamLines(process.stdout, NON_BLANK_LINE)
+      returncode = process.returncode
+    except OSError as e:
+      # Report the unit as failed instead of aborting the whole run.
+      print("Error: Cannot preprocess {}: {}".format(infile, e),
+            file=sys.stderr)
+      returncode = 1
+  loc = CountLines(infile, CODE_LINE) if count_loc else None
+  return loc, expanded, returncode
+
+
+TOKEI_BATCH_SIZE = 1000
+PENDING_UNITS_PER_CPU = 8
+
+
+def CountLocWithTokei(paths):
+  """Counts the code lines of the given files with one tokei run per batch.
+
+  Returns a dict from path to LoC. Files tokei does not recognize are counted
+  like without tokei.
+  """
+  locs = {}
+  for i in range(0, len(paths), TOKEI_BATCH_SIZE):
+    output = subprocess.check_output(
+        ['tokei', '--no-ignore', '--output', 'json',
+         *paths[i:i + TOKEI_BATCH_SIZE]])
+    for language in json.loads(output).values():
+      for report in language.get('reports', []):
+        locs[os.path.normpath(report['name'])] = report['stats']['code']
+  for path in paths:
+    if path not in locs:
+      locs[path] = CountLines(path, CODE_LINE)
+  return locs
+
+
+def LoadCompileCommands(file):
+  """Returns an iterable over the compilation units in the given file.
+
+  If ijson is available, units are parsed lazily one at a time so that huge
+  compilation databases do not have to be held in memory.
+  """
+  if ijson:
+    return ijson.items(file, 'item')
+  return json.load(file)
 
 
 def GenerateCompileCommandsAndBuild(build_dir, compile_commands_file, out):
@@ -141,6 +290,8 @@ def GenerateCompileCommandsAndBuild(build_dir, compile_commands_file, out):
 
 
 class CompilationData:
+  __slots__ = ('loc', 'expanded')
+
   def __init__(self, loc, expanded):
     self.loc = loc
     self.expanded = expanded
@@ -148,36 +299,60 @@ class CompilationData:
   def ratio(self):
     return self.expanded / (self.loc+1)
 
-  def to_string(self):
+  def to_string(self, count_expanded=True):
+    if not count_expanded:
+      return "{:>9,} (expansion not counted)".format(self.loc)
     return "{:>9,} to {:>12,} ({:>5.0f}x)".format(
         self.loc, self.expanded, self.ratio())
 
 
 class File(CompilationData):
+  __slots__ = ('file',)
+
   def __init__(self, file, loc, expanded):
     super().__init__(loc, expanded)
     self.file = file
 
-  def to_string(self):
-    return "{} {}".format(super().to_string(), self.file)
+  def to_string(self, count_expanded=True):
+    return "{} {}".format(super().to_string(count_expanded), self.file)
+
+
+# Regular expressions made up of plain characters and escaped punctuation.
+LITERAL_PATTERN = re.compile(r'(?:[^.^$*+?()[\]{}|\\]|\\\W)*')
+
+
+def LiteralPrefix(regexp_string):
+  """Returns the string regexp_string matches literally, or None."""
+  if not LITERAL_PATTERN.fullmatch(regexp_string):
+    return None
+  return re.sub(r'\\(.)', r'\1', regexp_string)
 
 
 class Group(CompilationData):
+  __slots__ = ('name', 'count', 'regexp', 'match')
+
   def __init__(self, name, regexp_string):
     super().__init__(0, 0)
     self.name = name
     self.count = 0
     self.regexp = re.compile(regexp_string)
+    # Most groups are plain path prefixes, which startswith() checks much
+    # faster than the regex engine.
+    prefix = LiteralPrefix(regexp_string)
+    if prefix is None:
+      self.match = self.regexp.match
+    else:
+      self.match = lambda filename: filename.startswith(prefix)
 
   def account(self, unit):
-    if (self.regexp.match(unit.file)):
+    if self.match(unit.file):
       self.loc += unit.loc
       self.expanded += unit.expanded
       self.count += 1
 
-  def to_string(self, name_width):
+  def to_string(self, name_width, count_expanded=True):
     return "{:<{}} ({:>5} files): {}".format(
-        self.name, name_width, self.count, super().to_string())
+        self.name, name_width, self.count, super().to_string(count_expanded))
 
 
 def SetupReportGroups():
@@ -217,68 +392,218 @@ def SetupReportGroups():
 
 
 class Results:
-  def __init__(self):
+  def __init__(self, count_expanded=True):
     self.groups = SetupReportGroups()
+    # Whether the size after preprocessing is counted at all.
+    self.count_expanded = count_expanded
     self.units = []
+    self.match_tracked = self.trackingMatcher()
+    # Bound once, as they are called for every recorded file.
+    self.accounts = tuple(group.account for group in self.groups.values())
+
+  def trackingMatcher(self):
+    groups = tuple(self.groups.values())
+    # Combine all group patterns into one alternation so that tracking a file
+    # takes a single regex match instead of one per group. '(?!)' never
+    # matches, i.e. nothing is tracked if there are no groups. Patterns with
+    # capturing groups would be renumbered or clash when joined, and global
+    # flags like '(?i)' are only valid at the start of a pattern, so in these
+    # cases the groups are matched one by one instead.
+    if all(group.regexp.groups == 0 for group in groups):
+      try:
+        return re.compile('|'.join(
+            '(?:{})'.format(group.regexp.pattern) for group in groups)
+            or '(?!)').match
+      except re.error:
+        pass
+    return lambda filename: any(group.match(filename) for group in groups)
 
   def track(self, filename):
-    is_tracked = False
-    for group in self.groups.values():
-      if group.regexp.match(filename):
-        is_tracked = True
-    return is_tracked
+    return bool(self.match_tracked(filename))
 
   def recordFile(self, filename, loc, expanded):
     unit = File(filename, loc, expanded)
     self.units.append(unit)
-    for group in self.groups.values():
-      group.account(unit)
+    for account in self.accounts:
+      account(unit)
 
   def maxGroupWidth(self):
     return MaxWidth([v.name for v in self.groups.values()])
 
   def printGroupResults(self, file):
+    max_group_width = self.maxGroupWidth()
     for key in sorted(self.groups.keys()):
-      print(self.groups[key].to_string(self.maxGroupWidth()), file=file)
+      print(self.groups[key].to_string(
+          max_group_width, self.count_expanded), file=file)
 
   def printSorted(self, key, count, reverse, out):
-    for unit in sorted(self.units, key=key, reverse=reverse)[:count]:
-      print(unit.to_string(), file=out)
-
-
-class LocsEncoder(json.JSONEncoder):
-  def default(self, o):
-    if isinstance(o, File):
-      return {"file": o.file, "loc": o.loc, "expanded": o.expanded}
-    if isinstance(o, Group):
-      return {"name": o.name, "loc": o.loc, "expanded": o.expanded}
-    if isinstance(o, Results):
-      return {"groups": o.groups, "units": o.units}
-    return json.JSONEncoder.default(self, o)
+    if reverse:
+      picks = heapq.nlargest(count, self.units, key=key)
+    else:
+      picks = heapq.nsmallest(count, self.units, key=key)
+    for unit in picks:
+      print(unit.to_string(self.count_expanded), file=out)
+
+
+def LocsDefault(o):
+  """Converts result objects for serialization with json or orjson."""
+  if isinstance(o, File):
+    return {"file": o.file, "loc": o.loc, "expanded": o.expanded}
+  if isinstance(o, Group):
+    return {"name": o.name, "loc": o.loc, "expanded": o.expanded}
+  if isinstance(o, Results):
+    return {"groups": o.groups, "units": o.units}
+  raise TypeError(
+      "Object of type {} is not JSON serializable".format(type(o).__name__))
+
+
+def PrintJson(result):
+  if orjson:
+    # orjson produces UTF-8 bytes, which go to stdout without re-encoding.
+    sys.stdout.flush()
+    sys.stdout.buffer.write(orjson.dumps(
+        result, default=LocsDefault, option=orjson.OPT_APPEND_NEWLINE))
+    sys.stdout.buffer.flush()
+  else:
+    print(json.dumps(result, ensure_ascii=False, default=LocsDefault))
 
 
 class StatusLine:
+  # Minimum number of seconds between two transient status updates.
+  UPDATE_INTERVAL = 0.05
+
   def __init__(self):
     self.max_width = 0
+    self.last_update = 0.0
 
   def print(self, statusline, end="\r", file=sys.stdout):
+    if end == "\r":
+      now = time.monotonic()
+      if now - self.last_update < self.UPDATE_INTERVAL:
+        return
+      self.last_update = now
     self.max_width = max(self.max_width, len(statusline))
     print("{0:<{1}}".format(statusline, self.max_width), end=end, file=file)
 
 
+class ResultCache:
+  """Results of previous runs, keyed by input file and compiler command.
+
+  An input file may be compiled by several units with different commands,
+  so each file maps to one entry per command. An entry is only reused if
+  the input file's modification time and size are unchanged.
+  """
+  VERSION = 2
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    try:
+      with open(path) as file:
+        data = json.load(file)
+      if isinstance(data, dict) and data.get('version') == self.VERSION:
+        self.entries = data['entries']
+    except (FileNotFoundError, ValueError):
+      pass
+
+  def signature(self, infile, clangcmd, loc_counter):
+    """Returns the pair (command key, file stamp) identifying a result."""
+    stat = os.stat(infile)
+    command = "{}:{}".format(
+        loc_counter, hashlib.sha1(clangcmd.encode()).hexdigest())
+    return command, [stat.st_mtime_ns, stat.st_size]
+
+  def get(self, infile, signature):
+    command, stamp = signature
+    entry = self.entries.get(infile, {}).get(command)
+    if entry and entry[:len(stamp)] == stamp:
+      return entry[len(stamp):]
+    return None
+
+  def put(self, infile, signature, loc, expanded):
+    command, stamp = signature
+    self.entries.setdefault(infile, {})[command] = stamp + [loc, expanded]
+
+  def save(self):
+    with open(self.path, 'w') as file:
+      json.dump({'version': self.VERSION, 'entries': self.entries}, file)
+
+
+class PendingUnit:
+  """A submitted compilation unit whose results are not recorded yet."""
+  def __init__(self, infilename, infile, future):
+    self.infilename = infilename
+    self.infile = infile
+    self.future = future
+    # Set if the LoC is counted with tokei; loc is filled in by UnitQueue.
+    self.tokei_path = None
+    self.loc = None
+    # Set if the results should be stored in the cache.
+    self.signature = None
+
+
+class UnitQueue:
+  """Records the results of pending units in submission order.
+
+  At most max_pending units are queued at a time, so that memory use does not
+  grow with the number of units in a streamed compile_commands.json.
+  """
+  def __init__(self, result, cache, status, out, max_pending):
+    self.result = result
+    self.cache = cache
+    self.status = status
+    self.out = out
+    self.max_pending = max_pending
+    self.pending = collections.deque()
+    self.submitted = 0
+    self.recorded = 0
+
+  def add(self, unit):
+    self.pending.append(unit)
+    self.submitted += 1
+    while len(self.pending) > self.max_pending:
+      self.recordNext()
+
+  def finish(self):
+    while self.pending:
+      self.recordNext()
+
+  def recordNext(self):
+    unit = self.pending.popleft()
+    if unit.tokei_path and unit.loc is None:
+      # Count all queued units with one tokei run while the workers go on.
+      batch = [unit, *(u for u in self.pending
+                       if u.tokei_path and u.loc is None)]
+      locs = CountLocWithTokei([u.tokei_path for u in batch])
+      for u in batch:
+        u.loc = locs[u.tokei_path]
+    loc, expanded, returncode = unit.future.result()
+    if unit.tokei_path:
+      loc = unit.loc
+    self.status.print("[{}/{}] Summing up {}".format(
+        self.recorded, self.submitted, unit.infilename), file=self.out)
+    self.result.recordFile(unit.infilename, loc, expanded)
+    self.recorded += 1
+    # Failed runs may have been cut short; recount them next time.
+    if unit.signature and returncode == 0:
+      self.cache.put(unit.infile, unit.signature, loc, expanded)
+
+
 class CommandSplitter:
   def __init__(self):
-    self.cmd_pattern = re.compile(
-        "([^\\s]*\\s+)?(?P<clangcmd>[^\\s]*clang.*)"
-        " -c (?P<infile>.*) -o (?P<outfile>.*)")
+    self.cmd_pattern = command_re.compile(
+        r"^(?:\S+\s+)?(?P<clangcmd>\S*clang\S*.*?)"
+        r" -c (?P<infile>\S+) -o (?P<outfile>\S+)")
 
-  def process(self, compilation_unit, temp_file_name):
+  def process(self, compilation_unit):
     cmd = self.cmd_pattern.match(compilation_unit['command'])
-    outfilename = cmd.group('outfile') + ".cc"
+    # Units of a build share their directory; interning keeps a single copy
+    # alive while units are queued.
+    clangcmd = cmd.group('clangcmd')
+    directory = sys.intern(compilation_unit['directory'])
     infilename = cmd.group('infile')
-    infile = Path(compilation_unit['directory']).joinpath(infilename)
-    outfile = Path(str(temp_file_name)).joinpath(outfilename)
-    return [cmd.group('clangcmd'), infilename, infile, outfile]
+    infile = os.path.join(directory, infilename)
+    return [clangcmd, infilename, infile, directory]
 
 
 def Main():
@@ -292,53 +617,83 @@ def Main():
         ARGS['build_dir'], compile_commands_file, out)
 
   try:
-    with open(compile_commands_file) as file:
-      data = json.load(file)
+    file = open(compile_commands_file, 'rb')
   except FileNotFoundError:
-    print("Error: Cannot read '{}'. Consult --help to get started.")
+    print("Error: Cannot read '{}'. Consult --help to get started.".format(
+        compile_commands_file))
     exit(1)
 
-  result = Results()
+  # Only sizes after expansion require running the preprocessor.
+  need_expanded = (ARGS['largest'] or ARGS['worst'] or ARGS['json'] or
+                   not (ARGS['smallest'] or ARGS['files']))
+  result = Results(need_expanded)
   status = StatusLine()
-
-  with tempfile.TemporaryDirectory(dir='/tmp/', prefix="locs.") as temp:
-    processes = []
+  use_tokei = ARGS['tokei'] and shutil.which('tokei') is not None
+  if ARGS['tokei'] and not use_tokei:
+    print("Warning: tokei not found, counting LoC without it.",
+          file=sys.stderr)
+  cache = None
+  if ARGS['cache']:
+    cache_file = os.path.join(
+        os.path.dirname(compile_commands_file), '.locs_cache.json')
+    cache = ResultCache(cache_file)
+
+  with file, \
+      concurrent.futures.ProcessPoolExecutor(
+          max_workers=os.cpu_count()) as executor:
+    # Keep enough units queued to keep all workers busy while results are
+    # recorded in order.
+    queue = UnitQueue(result, cache, status, out,
+                      max_pending=PENDING_UNITS_PER_CPU * os.cpu_count())
     start = time.time()
     cmd_splitter = CommandSplitter()
+    data = LoadCompileCommands(file)
+    # The number of units is unknown up front when streaming.
+    total = len(data) if isinstance(data, list) else "?"
 
     for i, key in enumerate(data):
       if not result.track(key['file']):
         continue
       if not ARGS['json']:
         status.print(
-            "[{}/{}] Counting LoCs of {}".format(i, len(data), key['file']))
-      clangcmd, infilename, infile, outfile = cmd_splitter.process(key, temp)
-      outfile.parent.mkdir(parents=True, exist_ok=True)
-      if infile.is_file():
-        clangcmd = clangcmd + " -E -P " + \
-            str(infile) + " -o /dev/stdout | sed '/^\\s*$/d' | wc -l"
-        loccmd = ("cat {}  | sed '\\;^\\s*//;d' | sed '\\;^/\\*;d'"
-                  " | sed '/^\\*/d' | sed '/^\\s*$/d' | wc -l").format(
-            infile)
-        runcmd = " {} ; {}".format(clangcmd, loccmd)
-        if ARGS['echocmd']:
-          print(runcmd)
-        p = subprocess.Popen(
-            runcmd, shell=True, cwd=key['directory'], stdout=subprocess.PIPE)
-        processes.append({'process': p, 'infile': infilename})
-
-    for i, p in enumerate(processes):
-      status.print("[{}/{}] Summing up {}".format(
-          i, len(processes), p['infile']), file=out)
-      output, err = p['process'].communicate()
-      expanded, loc = list(map(int, output.split()))
-      result.recordFile(p['infile'], loc, expanded)
+            "[{}/{}] Counting LoCs of {}".format(i, total, key['file']))
+      clangcmd, infilename, infile, directory = cmd_splitter.process(key)
+      if os.path.isfile(infile):
+        if cache:
+          signature = cache.signature(
+              infile, clangcmd, "tokei" if use_tokei else "locs.py")
+          cached = cache.get(infile, signature)
+          if cached:
+            loc, expanded = cached
+            if not need_expanded:
+              expanded = 0
+            future = concurrent.futures.Future()
+            future.set_result((loc, expanded, 0))
+            queue.add(PendingUnit(infilename, infile, future))
+            continue
+        argv = None
+        if need_expanded:
+          argv = CompilerArgv(clangcmd) + ['-E', '-P', infile]
+          if ARGS['echocmd']:
+            print(shlex.join(argv))
+        future = executor.submit(ProcessCompilationUnit, argv, directory,
+                                 infile, not use_tokei)
+        unit = PendingUnit(infilename, infile, future)
+        if use_tokei:
+          unit.tokei_path = os.path.normpath(infile)
+        if cache and need_expanded:
+          unit.signature = signature
+        queue.add(unit)
+
+    queue.finish()
+    if cache:
+      cache.save()
 
     end = time.time()
     if ARGS['json']:
-      print(json.dumps(result, ensure_ascii=False, cls=LocsEncoder))
+      PrintJson(result)
     status.print("Processed {:,} files in {:,.2f} sec.".format(
-        len(processes), end-start), end="\n", file=out)
+        queue.recorded, end-start), end="\n", file=out)
     result.printGroupResults(file=out)
 
     if ARGS['largest']: